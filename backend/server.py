@@ -2,13 +2,18 @@ from fastapi import FastAPI, APIRouter, HTTPException
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
 import os
+import asyncio
+import gzip
+import json
 import logging
 from pathlib import Path
 from pydantic import BaseModel, Field
-from typing import List, Optional
+from typing import List, Optional, Tuple, Union
 import uuid
-from datetime import datetime
+from datetime import datetime, timedelta
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
@@ -18,6 +23,33 @@ mongo_url = os.environ['MONGO_URL']
 client = AsyncIOMotorClient(mongo_url)
 db = client[os.environ['DB_NAME']]
 
+# Retention of stored calculations
+# Raw documents older than COMPACT_AFTER_DAYS are archived to ARCHIVE_DIR,
+# rolled into daily summaries and deleted. The TTL index bounds the hot tier
+# even if the compactor stops working: raw documents it has not reached within
+# RAW_TTL_DAYS are deleted WITHOUT being archived or summarized. Keep the gap
+# between both settings larger than any compactor outage you want to survive.
+# On startup the TTL is parked and only set to RAW_TTL_DAYS once the compactor
+# has drained every raw document older than that, so an existing backlog is
+# never expired unarchived.
+# Archives are written as one gzip JSON-lines file per compaction batch and day
+# (salary_calculations-<YYYY-MM-DD>-<batch id>.jsonl.gz, up to
+# COMPACTION_BATCH_SIZE lines each). Each file is written atomically, which is
+# what makes replaying an interrupted batch safe; concatenate a day's files
+# (e.g. `cat salary_calculations-2025-01-05-*.jsonl.gz`) to read it as one.
+COMPACT_AFTER_DAYS = int(os.environ.get('CALCULATION_COMPACT_AFTER_DAYS', '30'))
+RAW_TTL_DAYS = int(os.environ.get('CALCULATION_RAW_TTL_DAYS', '90'))
+COMPACTION_INTERVAL_SECONDS = int(os.environ.get('CALCULATION_COMPACTION_INTERVAL_SECONDS', '3600'))
+COMPACTION_BATCH_SIZE = 1000
+RAW_TTL_PARKED_SECONDS = 2147483647  # Largest TTL MongoDB accepts (~68 years)
+COMPACTION_LEASE_SECONDS = 600  # Renewed before every batch
+COMPACTION_OWNER = str(uuid.uuid4())  # Identifies this process when holding the lease
+ARCHIVE_DIR = Path(os.environ.get('CALCULATION_ARCHIVE_DIR', str(ROOT_DIR / 'archive')))
+
+if RAW_TTL_DAYS <= COMPACT_AFTER_DAYS:
+    raise RuntimeError("CALCULATION_RAW_TTL_DAYS must be greater than CALCULATION_COMPACT_AFTER_DAYS, "
+                       "otherwise raw calculations expire before being archived")
+
 # Create the main app without a prefix
 app = FastAPI()
 
@@ -57,6 +89,22 @@ class CalculationResult(BaseModel):
     irps_calculation_details: dict
     timestamp: datetime = Field(default_factory=datetime.utcnow)
 
+class CalculationSummary(BaseModel):
+    """Compacted calculations for one UTC day and one IRPS bracket (amounts are averages)"""
+    id: str
+    tier: str = "compacted"
+    timestamp: datetime  # Start of the day bucket
+    bracket_lower_limit: float
+    count: int
+    gross_salary: float
+    net_salary: float
+    irps_tax: float
+    inss_employee: float
+    inss_employer: float
+    total_discounts: float
+    gross_salary_min: float
+    gross_salary_max: float
+
 class CalculationHistory(BaseModel):
     calculations: List[CalculationResult]
 
@@ -202,6 +250,227 @@ def calculate_gross_from_net(net_salary: float, medical_aid: float = 0, loans: f
     
     return calculate_net_from_gross(gross_estimate, medical_aid, loans, other_discounts, dependents)
 
+# Retention: hot tier (salary_calculations) -> compacted tier (salary_calculation_summaries)
+# Amounts summed into each summary; averages are derived from them on read
+SUMMARY_AMOUNT_FIELDS = ["gross_salary", "net_salary", "irps_tax", "inss_employee", "inss_employer", "total_discounts"]
+
+async def set_raw_ttl(ttl_seconds: int):
+    """Create the TTL index on raw calculations, or change the TTL of the existing one"""
+    try:
+        await db.salary_calculations.create_index("timestamp", name="timestamp_ttl", expireAfterSeconds=ttl_seconds)
+    except OperationFailure as e:
+        if e.code != 85:  # IndexOptionsConflict
+            raise
+        # A timestamp index already exists (different TTL or name): update it in place
+        await db.command("collMod", "salary_calculations",
+                         index={"keyPattern": {"timestamp": 1}, "expireAfterSeconds": ttl_seconds})
+
+async def ensure_retention_indexes():
+    """Create the compaction and history indexes, with the raw TTL parked until the backlog is drained"""
+    await db.salary_calculations.create_index(
+        "compaction_batch", partialFilterExpression={"compaction_batch": {"$exists": True}}
+    )
+    await db.salary_calculation_summaries.create_index([("timestamp", -1), ("bracket_lower_limit", 1)])
+    # Also serves the compactor's timestamp range scans while the TTL is parked
+    await set_raw_ttl(RAW_TTL_PARKED_SECONDS)
+
+async def enable_raw_ttl() -> bool:
+    """Set the real TTL once no raw calculation old enough to expire is left uncompacted"""
+    ttl_cutoff = datetime.utcnow() - timedelta(days=RAW_TTL_DAYS)
+    if await db.salary_calculations.find_one({"timestamp": {"$lt": ttl_cutoff}}, {"_id": 1}):
+        return False
+    await set_raw_ttl(RAW_TTL_DAYS * 24 * 3600)
+    return True
+
+def day_start(moment: datetime) -> datetime:
+    return moment.replace(hour=0, minute=0, second=0, microsecond=0)
+
+def compaction_cutoff(now: datetime) -> datetime:
+    """Calculations strictly before this moment are compacted; aligned to midnight UTC"""
+    return day_start(now - timedelta(days=COMPACT_AFTER_DAYS))
+
+def archive_calculations(day: datetime, batch_id: str, calculations: List[dict]):
+    """Write one batch's raw calculations for a day to a gzip JSON-lines archive"""
+    archive_path = ARCHIVE_DIR / f"salary_calculations-{day:%Y-%m-%d}-{batch_id}.jsonl.gz"
+    if archive_path.exists():
+        # Written completely by an interrupted run, before anything was deleted
+        return
+    ARCHIVE_DIR.mkdir(parents=True, exist_ok=True)
+    temp_path = archive_path.with_name(archive_path.name + ".tmp")
+    with gzip.open(temp_path, "wt", encoding="utf-8") as archive:
+        for calc in calculations:
+            archive.write(json.dumps(calc, default=str) + "\n")
+    os.replace(temp_path, archive_path)
+
+def summarize_calculations(day: datetime, batch_id: str, calculations: List[dict]) -> List[UpdateOne]:
+    """
+    Build summary upserts aggregating calculations per IRPS bracket.
+    Each upsert skips summaries that already recorded batch_id, so replaying a
+    batch never counts it twice (the upsert then fails with a duplicate key).
+    """
+    buckets = {}
+    for calc in calculations:
+        bracket = calc.get("irps_calculation_details", {}).get("lower_limit", 0)
+        bucket = buckets.setdefault(bracket, {
+            "count": 0,
+            "totals": {field: 0.0 for field in SUMMARY_AMOUNT_FIELDS},
+            "gross_salary_min": calc["gross_salary"],
+            "gross_salary_max": calc["gross_salary"]
+        })
+        bucket["count"] += 1
+        for field in SUMMARY_AMOUNT_FIELDS:
+            bucket["totals"][field] += calc[field]
+        bucket["gross_salary_min"] = min(bucket["gross_salary_min"], calc["gross_salary"])
+        bucket["gross_salary_max"] = max(bucket["gross_salary_max"], calc["gross_salary"])
+
+    operations = []
+    for bracket, bucket in buckets.items():
+        summary_id = f"{day:%Y-%m-%d}:{bracket}"
+        increments = {"count": bucket["count"]}
+        increments.update({f"{field}_total": total for field, total in bucket["totals"].items()})
+        operations.append(UpdateOne(
+            {"_id": summary_id, "compaction_batches": {"$ne": batch_id}},
+            {
+                "$setOnInsert": {"id": summary_id, "timestamp": day, "bracket_lower_limit": bracket},
+                "$inc": increments,
+                "$min": {"gross_salary_min": bucket["gross_salary_min"]},
+                "$max": {"gross_salary_max": bucket["gross_salary_max"]},
+                "$push": {"compaction_batches": batch_id}
+            },
+            upsert=True
+        ))
+    return operations
+
+def summary_from_bucket(bucket: dict) -> CalculationSummary:
+    """Turn a stored summary into a history entry with per-calculation averages"""
+    count = bucket["count"]
+    return CalculationSummary(
+        id=bucket["id"],
+        timestamp=bucket["timestamp"],
+        bracket_lower_limit=bucket["bracket_lower_limit"],
+        count=count,
+        gross_salary_min=bucket["gross_salary_min"],
+        gross_salary_max=bucket["gross_salary_max"],
+        **{field: bucket[f"{field}_total"] / count for field in SUMMARY_AMOUNT_FIELDS}
+    )
+
+async def acquire_compaction_lease() -> bool:
+    """Take or renew the lease that lets a single process compact at a time"""
+    now = datetime.utcnow()
+    try:
+        await db.retention_locks.find_one_and_update(
+            {
+                "_id": "salary_calculations_compaction",
+                "$or": [{"owner": COMPACTION_OWNER}, {"expires_at": {"$lt": now}}]
+            },
+            {"$set": {"owner": COMPACTION_OWNER, "expires_at": now + timedelta(seconds=COMPACTION_LEASE_SECONDS)}},
+            upsert=True
+        )
+        return True
+    except DuplicateKeyError:
+        # Held by another process
+        return False
+
+async def release_compaction_lease():
+    await db.retention_locks.update_one(
+        {"_id": "salary_calculations_compaction", "owner": COMPACTION_OWNER},
+        {"$set": {"expires_at": datetime.utcnow()}}
+    )
+
+async def claim_compaction_batch(cutoff: datetime) -> Optional[Tuple[str, list]]:
+    """
+    Tag up to COMPACTION_BATCH_SIZE raw calculations older than cutoff with a
+    batch id and return it with the tagged _ids. A batch left tagged by an
+    interrupted run is resumed first.
+    """
+    pending = await db.salary_calculations.find_one({"compaction_batch": {"$exists": True}}, {"compaction_batch": 1})
+    if pending:
+        batch_id = pending["compaction_batch"]
+        tagged = await db.salary_calculations.find({"compaction_batch": batch_id}, {"_id": 1}).to_list(None)
+        return batch_id, [calc["_id"] for calc in tagged]
+
+    candidates = await db.salary_calculations.find(
+        {"timestamp": {"$lt": cutoff}, "compaction_batch": {"$exists": False}}, {"_id": 1}
+    ).sort("timestamp", 1).limit(COMPACTION_BATCH_SIZE).to_list(COMPACTION_BATCH_SIZE)
+    if not candidates:
+        return None
+
+    batch_id = str(uuid.uuid4())
+    calculation_ids = [calc["_id"] for calc in candidates]
+    await db.salary_calculations.update_many(
+        {"_id": {"$in": calculation_ids}, "compaction_batch": {"$exists": False}},
+        {"$set": {"compaction_batch": batch_id}}
+    )
+    return batch_id, calculation_ids
+
+async def compact_batch(batch_id: str, calculation_ids: list) -> int:
+    """Archive, summarize and delete one claimed batch; safe to replay after an interruption"""
+    # Ids not tagged with batch_id were claimed by someone else in the meantime
+    batch_query = {"_id": {"$in": calculation_ids}, "compaction_batch": batch_id}
+    calculations = await db.salary_calculations.find(batch_query).to_list(None)
+
+    by_day = {}
+    for calc in calculations:
+        by_day.setdefault(day_start(calc["timestamp"]), []).append(calc)
+
+    operations = []
+    for day, day_calculations in by_day.items():
+        # Archive before anything is removed so compacted raw data is kept
+        await asyncio.to_thread(archive_calculations, day, batch_id, day_calculations)
+        operations.extend(summarize_calculations(day, batch_id, day_calculations))
+
+    if operations:
+        try:
+            await db.salary_calculation_summaries.bulk_write(operations, ordered=False)
+        except BulkWriteError as e:
+            # Duplicate keys are summaries that already counted this batch
+            if any(error["code"] != 11000 for error in e.details["writeErrors"]):
+                raise
+    await db.salary_calculations.delete_many(batch_query)
+    return len(calculations)
+
+async def compact_calculations(now: Optional[datetime] = None, stop: Optional[asyncio.Event] = None) -> int:
+    """
+    Archive, summarize and delete raw calculations older than COMPACT_AFTER_DAYS.
+    The cutoff is aligned to midnight UTC so each day is compacted as a whole
+    and the hot tier only ever holds days newer than the compacted tier.
+    Returns the number of raw calculations compacted.
+    """
+    cutoff = compaction_cutoff(now or datetime.utcnow())
+    compacted = 0
+
+    if not await acquire_compaction_lease():
+        return 0
+    try:
+        while not (stop and stop.is_set()):
+            batch = await claim_compaction_batch(cutoff)
+            if batch is None:
+                break
+            compacted += await compact_batch(*batch)
+            if not await acquire_compaction_lease():
+                break
+    finally:
+        await release_compaction_lease()
+
+    if compacted:
+        logger.info(f"Compacted {compacted} salary calculations older than {cutoff:%Y-%m-%d}")
+    return compacted
+
+async def run_compaction_loop(stop: asyncio.Event):
+    """Periodically compact old calculations until stop is set"""
+    ttl_enabled = False
+    while not stop.is_set():
+        try:
+            await compact_calculations(stop=stop)
+            if not ttl_enabled:
+                ttl_enabled = await enable_raw_ttl()
+        except Exception:
+            logger.exception("Salary calculation compaction failed")
+        try:
+            await asyncio.wait_for(stop.wait(), timeout=COMPACTION_INTERVAL_SECONDS)
+        except asyncio.TimeoutError:
+            pass
+
 # API Routes
 @api_router.get("/")
 async def root():
@@ -270,11 +539,26 @@ async def calculate_salary(input_data: CalculationInput):
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Erro no cálculo: {str(e)}")
 
-@api_router.get("/calculation-history", response_model=List[CalculationResult])
+@api_router.get("/calculation-history", response_model=List[Union[CalculationResult, CalculationSummary]])
 async def get_calculation_history(limit: int = 10):
     try:
         calculations = await db.salary_calculations.find().sort("timestamp", -1).limit(limit).to_list(limit)
-        return [CalculationResult(**calc) for calc in calculations]
+        history = [CalculationResult(**calc) for calc in calculations]
+
+        # Older history lives in the compacted tier as daily summaries; each
+        # summary stands for `count` calculations towards the limit
+        remaining = limit - len(history)
+        if remaining > 0:
+            summaries = await db.salary_calculation_summaries.find().sort(
+                [("timestamp", -1), ("bracket_lower_limit", 1)]
+            ).limit(remaining).to_list(remaining)
+            for summary in summaries:
+                if remaining <= 0:
+                    break
+                history.append(summary_from_bucket(summary))
+                remaining -= summary["count"]
+
+        return history
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Erro ao buscar histórico: {str(e)}")
 
@@ -325,6 +609,20 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+@app.on_event("startup")
+async def start_retention():
+    try:
+        await ensure_retention_indexes()
+    except Exception:
+        logger.exception("Could not create retention indexes")
+    app.state.compaction_stop = asyncio.Event()
+    app.state.compaction_task = asyncio.create_task(run_compaction_loop(app.state.compaction_stop))
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    compaction_task = getattr(app.state, "compaction_task", None)
+    if compaction_task:
+        # Let the current batch finish instead of cancelling it halfway
+        app.state.compaction_stop.set()
+        await compaction_task
     client.close()
\ No newline at end of file
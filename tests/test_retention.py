@@ -0,0 +1,321 @@
+import asyncio
+import gzip
+import os
+import sys
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import pytest
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "test_database")
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+import server  # noqa: E402
+
+
+# In-memory stand-in for the handful of Motor operations the retention code uses
+def matches(doc, query):
+    for key, condition in query.items():
+        if key == "$or":
+            if not any(matches(doc, option) for option in condition):
+                return False
+            continue
+        value = doc.get(key)
+        if isinstance(condition, dict):
+            for op, operand in condition.items():
+                if op == "$lt" and not (value is not None and value < operand):
+                    return False
+                if op == "$exists" and (key in doc) != operand:
+                    return False
+                if op == "$in" and value not in operand:
+                    return False
+                if op == "$ne" and (operand == value or (isinstance(value, list) and operand in value)):
+                    return False
+        elif value != condition:
+            return False
+    return True
+
+
+def apply_update(doc, update, inserting):
+    for key, value in update.get("$setOnInsert", {}).items() if inserting else []:
+        doc[key] = value
+    for key, value in update.get("$set", {}).items():
+        doc[key] = value
+    for key, value in update.get("$inc", {}).items():
+        doc[key] = doc.get(key, 0) + value
+    for key, value in update.get("$min", {}).items():
+        doc[key] = min(doc[key], value) if key in doc else value
+    for key, value in update.get("$max", {}).items():
+        doc[key] = max(doc[key], value) if key in doc else value
+    for key, value in update.get("$push", {}).items():
+        doc.setdefault(key, []).append(value)
+
+
+class FakeCursor:
+    def __init__(self, docs):
+        self.docs = docs
+
+    def sort(self, key, direction=None):
+        keys = key if isinstance(key, list) else [(key, direction)]
+        for field, order in reversed(keys):
+            self.docs.sort(key=lambda doc: doc[field], reverse=order == -1)
+        return self
+
+    def limit(self, count):
+        self.docs = self.docs[:count]
+        return self
+
+    async def to_list(self, length):
+        return list(self.docs)
+
+
+class FakeCollection:
+    def __init__(self, database=None):
+        self.database = database
+        self.docs = []
+
+    async def create_index(self, keys, **kwargs):
+        self.database.index_log.append((keys, kwargs, self.database.snapshot()))
+
+    def find(self, query=None, projection=None):
+        return FakeCursor([doc for doc in self.docs if matches(doc, query or {})])
+
+    async def find_one(self, query, projection=None):
+        found = [doc for doc in self.docs if matches(doc, query)]
+        return found[0] if found else None
+
+    async def update_one(self, query, update, upsert=False):
+        found = [doc for doc in self.docs if matches(doc, query)]
+        if found:
+            apply_update(found[0], update, inserting=False)
+        elif upsert:
+            if any(doc["_id"] == query["_id"] for doc in self.docs):
+                raise DuplicateKeyError("E11000 duplicate key")
+            doc = {"_id": query["_id"]}
+            apply_update(doc, update, inserting=True)
+            self.docs.append(doc)
+
+    async def find_one_and_update(self, query, update, upsert=False):
+        await self.update_one(query, update, upsert)
+
+    async def update_many(self, query, update):
+        for doc in self.docs:
+            if matches(doc, query):
+                apply_update(doc, update, inserting=False)
+
+    async def delete_many(self, query):
+        self.docs = [doc for doc in self.docs if not matches(doc, query)]
+
+    async def bulk_write(self, operations, ordered=True):
+        errors = []
+        for index, operation in enumerate(operations):
+            try:
+                await self.update_one(operation._filter, operation._doc, operation._upsert)
+            except DuplicateKeyError:
+                errors.append({"index": index, "code": 11000})
+        if errors:
+            raise BulkWriteError({"writeErrors": errors})
+
+
+class FakeDatabase:
+    def __init__(self):
+        self.salary_calculations = FakeCollection(self)
+        self.salary_calculation_summaries = FakeCollection(self)
+        self.retention_locks = FakeCollection(self)
+        # (keys, options, (raw count, summary count)) for every index created
+        self.index_log = []
+
+    def snapshot(self):
+        return len(self.salary_calculations.docs), len(self.salary_calculation_summaries.docs)
+
+    def ttl_settings(self):
+        return [
+            (options["expireAfterSeconds"], state) for keys, options, state in self.index_log
+            if "expireAfterSeconds" in options
+        ]
+
+
+@pytest.fixture
+def fake_db(monkeypatch, tmp_path):
+    database = FakeDatabase()
+    monkeypatch.setattr(server, "db", database)
+    monkeypatch.setattr(server, "ARCHIVE_DIR", tmp_path)
+    return database
+
+
+def make_calculation(salary, timestamp):
+    result = server.calculate_net_from_gross(salary)
+    result.update({
+        "_id": f"{timestamp.isoformat()}-{salary}",
+        "id": f"{timestamp.isoformat()}-{salary}",
+        "monthly_breakdown": {},
+        "annual_breakdown": {},
+        "calculation_type": "gross_to_net",
+        "timestamp": timestamp
+    })
+    return result
+
+
+def test_summarize_calculations_buckets_by_bracket():
+    day = datetime(2025, 1, 5)
+    calculations = [
+        make_calculation(25000, datetime(2025, 1, 5, 9)),
+        make_calculation(30000, datetime(2025, 1, 5, 10)),
+        make_calculation(50000, datetime(2025, 1, 5, 11))
+    ]
+
+    operations = server.summarize_calculations(day, "batch-1", calculations)
+
+    by_id = {operation._filter["_id"]: operation for operation in operations}
+    assert set(by_id) == {"2025-01-05:22250", "2025-01-05:32750"}
+    operation = by_id["2025-01-05:22250"]
+    assert operation._filter["compaction_batches"] == {"$ne": "batch-1"}
+    assert operation._upsert
+    update = operation._doc
+    assert set(update["$inc"]) == {"count"} | {f"{field}_total" for field in server.SUMMARY_AMOUNT_FIELDS}
+    assert update["$inc"]["count"] == 2
+    assert update["$inc"]["gross_salary_total"] == 55000
+    assert update["$min"] == {"gross_salary_min": 25000}
+    assert update["$max"] == {"gross_salary_max": 30000}
+    assert update["$push"] == {"compaction_batches": "batch-1"}
+
+
+def test_compaction_cutoff_is_aligned_to_midnight():
+    cutoff = server.compaction_cutoff(datetime(2025, 3, 31, 17, 45, 12))
+    assert cutoff == datetime(2025, 3, 1)
+
+
+def test_compact_calculations_archives_summarizes_and_deletes(fake_db, tmp_path):
+    old = make_calculation(25000, datetime(2025, 1, 5, 9))
+    recent = make_calculation(30000, datetime(2025, 2, 20, 9))
+    fake_db.salary_calculations.docs = [old, recent]
+
+    compacted = asyncio.run(server.compact_calculations(now=datetime(2025, 3, 1, 12)))
+
+    assert compacted == 1
+    assert [doc["id"] for doc in fake_db.salary_calculations.docs] == [recent["id"]]
+    [summary] = fake_db.salary_calculation_summaries.docs
+    assert summary["count"] == 1
+    assert summary["gross_salary_total"] == 25000
+    [archive] = tmp_path.glob("salary_calculations-2025-01-05-*.jsonl.gz")
+    with gzip.open(archive, "rt", encoding="utf-8") as lines:
+        assert len(lines.readlines()) == 1
+
+
+def test_compact_batch_replay_does_not_double_count(fake_db, tmp_path):
+    fake_db.salary_calculations.docs = [make_calculation(25000, datetime(2025, 1, 5, 9))]
+    batch_id, calculation_ids = asyncio.run(server.claim_compaction_batch(datetime(2025, 2, 1)))
+
+    # Simulate a run interrupted after the summary upsert but before the delete
+    original_delete = fake_db.salary_calculations.delete_many
+
+    async def failing_delete(query):
+        raise RuntimeError("connection lost")
+
+    fake_db.salary_calculations.delete_many = failing_delete
+    with pytest.raises(RuntimeError):
+        asyncio.run(server.compact_batch(batch_id, calculation_ids))
+    fake_db.salary_calculations.delete_many = original_delete
+
+    # The next run resumes the tagged batch
+    assert asyncio.run(server.claim_compaction_batch(datetime(2025, 2, 1))) == (batch_id, calculation_ids)
+    asyncio.run(server.compact_batch(batch_id, calculation_ids))
+
+    [summary] = fake_db.salary_calculation_summaries.docs
+    assert summary["count"] == 1
+    assert summary["gross_salary_total"] == 25000
+    assert fake_db.salary_calculations.docs == []
+    assert len(list(tmp_path.glob("*.jsonl.gz"))) == 1
+
+
+def test_compaction_lease_is_exclusive(fake_db, monkeypatch):
+    assert asyncio.run(server.acquire_compaction_lease())
+
+    monkeypatch.setattr(server, "COMPACTION_OWNER", "another-process")
+    assert not asyncio.run(server.acquire_compaction_lease())
+    assert asyncio.run(server.compact_calculations(now=datetime(2025, 3, 1))) == 0
+
+
+def test_calculation_history_fills_from_compacted_tier(fake_db):
+    fake_db.salary_calculations.docs = [make_calculation(30000, datetime(2025, 2, 20, 9))]
+    summary = {
+        "_id": "2025-01-05:22250",
+        "id": "2025-01-05:22250",
+        "timestamp": datetime(2025, 1, 5),
+        "bracket_lower_limit": 22250,
+        "count": 4,
+        "gross_salary_min": 24000,
+        "gross_salary_max": 26000,
+        "compaction_batches": ["batch-1"]
+    }
+    summary.update({f"{field}_total": 4000.0 for field in server.SUMMARY_AMOUNT_FIELDS})
+    older_summary = dict(summary, _id="2025-01-04:22250", id="2025-01-04:22250", timestamp=datetime(2025, 1, 4))
+    fake_db.salary_calculation_summaries.docs = [older_summary, summary]
+
+    history = asyncio.run(server.get_calculation_history(limit=3))
+
+    # The first summary already stands for more calculations than the limit left
+    assert [entry.id for entry in history] == [fake_db.salary_calculations.docs[0]["id"], "2025-01-05:22250"]
+    compacted = history[1]
+    assert compacted.tier == "compacted"
+    assert compacted.count == 4
+    assert compacted.gross_salary == 1000.0
+
+
+def test_ttl_index_conflict_updates_existing_index(monkeypatch):
+    commands = []
+
+    class ConflictingCollection:
+        async def create_index(self, *args, **kwargs):
+            if "expireAfterSeconds" in kwargs:
+                raise server.OperationFailure("Index already exists with a different name", code=85)
+
+    class SummaryCollection:
+        async def create_index(self, *args, **kwargs):
+            pass
+
+    class IndexDatabase:
+        salary_calculations = ConflictingCollection()
+        salary_calculation_summaries = SummaryCollection()
+
+        async def command(self, *args, **kwargs):
+            commands.append((args, kwargs))
+
+    monkeypatch.setattr(server, "db", IndexDatabase())
+    asyncio.run(server.ensure_retention_indexes())
+
+    [(args, kwargs)] = commands
+    assert args == ("collMod", "salary_calculations")
+    assert kwargs["index"] == {"keyPattern": {"timestamp": 1}, "expireAfterSeconds": server.RAW_TTL_PARKED_SECONDS}
+
+
+def test_summary_index_matches_history_sort(fake_db):
+    asyncio.run(server.ensure_retention_indexes())
+
+    index_keys = [keys for keys, options, state in fake_db.index_log]
+    assert [("timestamp", -1), ("bracket_lower_limit", 1)] in index_keys
+
+
+def test_ttl_is_only_set_after_backlog_is_compacted(fake_db, tmp_path):
+    expired = server.day_start(datetime.utcnow() - timedelta(days=server.RAW_TTL_DAYS + 30))
+    fake_db.salary_calculations.docs = [
+        make_calculation(25000 + index, expired + timedelta(minutes=index)) for index in range(3)
+    ]
+
+    asyncio.run(server.ensure_retention_indexes())
+    # The backlog is still there, so the TTL stays parked
+    assert fake_db.ttl_settings() == [(server.RAW_TTL_PARKED_SECONDS, (3, 0))]
+    assert not asyncio.run(server.enable_raw_ttl())
+
+    # One pass of the compaction loop: compact, then enable the TTL
+    assert asyncio.run(server.compact_calculations()) == 3
+    assert asyncio.run(server.enable_raw_ttl())
+
+    ttl_seconds, (raw_count, summary_count) = fake_db.ttl_settings()[-1]
+    assert ttl_seconds == server.RAW_TTL_DAYS * 24 * 3600
+    assert raw_count == 0 and summary_count == 1
+    [archive] = tmp_path.glob("*.jsonl.gz")
+    with gzip.open(archive, "rt", encoding="utf-8") as lines:
+        assert len(lines.readlines()) == 3